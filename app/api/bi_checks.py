@@ -4,9 +4,13 @@ import flask
 from flask import request, Response
 from flask_restful import inputs
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 import gspread
-from io import StringIO
+import threading
+import uuid
 from oauth2client.service_account import ServiceAccountCredentials
 
 import numpy as np
@@ -24,8 +28,8 @@ Steps for use:
 3) Run this script from the top-level directory:
    python scripts/check-new-bi-data.py
 
-The output is printed out in a comma-separated string, meant for pasting directly into a Google
-Sheet (and letting it algorithmically separate into columns).
+The output is one row per issue (State, Issue, Metric, Details), written to a new tab of the
+checks Google Sheet.
 """
 
 
@@ -36,60 +40,114 @@ Sheet (and letting it algorithmically separate into columns).
 
 _EXISTING_CSV_URL = 'https://raw.githubusercontent.com/pandemic-tracking/bi/main/US%20states%20breakthrough%20reporting%20-%20Snapshot.csv'
 
+# Character cleanups applied in a single pass before numeric conversion: drop thousands
+# separators and percent signs, and replace "X" characters with the number 1 since they're
+# generally placeholders
+_NUMERIC_TRANS = str.maketrans({',': '', 'X': '1'})
+_PERCENT_TRANS = str.maketrans({'%': '', 'X': '1'})
 
-def make_output_string(gc):
+_CHECKS_HEADER = ['State', 'Issue', 'Metric', 'Details']
 
-    out = ''
 
-    # Load new CSV file (current spreadsheet)
-    sh = gc.open_by_key(flask.current_app.config['SNAPSHOT_SHEET_ID'])
+def _fetch_new(gc, sheet_id):
+    """Loads the current Snapshot tab of the Google Sheet, with every cell as a string."""
+    sh = gc.open_by_key(sheet_id)
     worksheet = sh.worksheet("Snapshot")
-    # need to get everything as strings first and let pandas do the conversion later
-    records = [{k: str(v) for k, v in record.items()} for record in worksheet.get_all_records()]
-    new_df = pd.DataFrame(records)
-
-    # Load existing sheet snapshot from GitHub
-    existing_df = pd.read_csv(_EXISTING_CSV_URL)
-
+    # need to get everything as strings first and let pandas do the conversion later; every cell
+    # is already a str, so declaring object dtype skips pandas' per-column type inference pass
+    values = worksheet.get_all_values()
+    return pd.DataFrame(values[1:], columns=values[0], dtype=object)
+
+
+def _fetch_existing():
+    """Loads the existing sheet snapshot from GitHub."""
+    return pd.read_csv(_EXISTING_CSV_URL)
+
+
+def _scan_checks(new_mat, old_mat, is_numeric, not_whitelisted):
+    """Runs the per-value checks over aligned (state x column) matrices.
+
+    is_numeric and not_whitelisted are per-column masks: only numeric columns are compared by
+    value, and only non-whitelisted ones can raise a cumulative decrease. Returns one boolean
+    matrix per check, (lost, gained, decreased, doubled); formatting is left to the caller.
+    """
+    # Check things that were previously reported that are not now, and vice versa
+    new_missing = np.isnan(new_mat)
+    old_missing = np.isnan(old_mat)
+    lost = new_missing & ~old_missing
+    gained = ~new_missing & old_missing
+    # Check any cumulative numbers that went down, and increase magnitude (alert if >2x), only
+    # where both values are reported
+    compared = ~(new_missing | old_missing) & is_numeric
+    with np.errstate(invalid='ignore'):
+        decreased = (new_mat < old_mat) & compared & not_whitelisted
+        doubled = (new_mat > 2 * old_mat) & compared
+    return lost, gained, decreased, doubled
+
+
+@lru_cache(maxsize=4)
+def _classify_cols(columns):
+    """Splits the sheet's numeric column span into (numeric_cols, percent_cols).
+
+    The sheet schema rarely changes, so this is cached on the tuple of column names.
+    """
     first_numeric_colname = 'BI cases'
     last_numeric_colname = 'Total Individuals not fully vaccinated'
-    first_numeric_col = list(new_df.columns).index(first_numeric_colname)
-    last_numeric_col = list(new_df.columns).index(last_numeric_colname)
+    column_index = pd.Index(columns)
+    first_numeric_col = column_index.get_loc(first_numeric_colname)
+    last_numeric_col = column_index.get_loc(last_numeric_colname)
 
-    possible_numeric_cols = list(new_df.columns[first_numeric_col:last_numeric_col+1])
+    possible_numeric_cols = columns[first_numeric_col:last_numeric_col+1]
 
     # some of these are percent columns and should be read as such
-    percent_cols = [x for x in possible_numeric_cols if 'percent' in x]
-    numeric_cols = [x for x in possible_numeric_cols if 'percent' not in x]
+    percent_cols = tuple(x for x in possible_numeric_cols if 'percent' in x)
+    numeric_cols = tuple(x for x in possible_numeric_cols if 'percent' not in x)
+    return numeric_cols, percent_cols
+
+
+def make_check_rows(gc):
+    """Runs the QA checks, returning one row per issue found, padded to the width of
+    _CHECKS_HEADER and ready to be written to the checks sheet."""
+
+    rows = []
 
-    # do numeric and percent conversions
+    def emit(*fields):
+        fields = [str(field) for field in fields]
+        rows.append(fields + [''] * (len(_CHECKS_HEADER) - len(fields)))
+
+    # Load new CSV file (current spreadsheet) and existing snapshot; both are network-bound, so
+    # fetch them in parallel. The app config has to be read here, outside the worker threads.
+    sheet_id = flask.current_app.config['SNAPSHOT_SHEET_ID']
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        new_future = executor.submit(_fetch_new, gc, sheet_id)
+        existing_future = executor.submit(_fetch_existing)
+        new_df = new_future.result()
+        existing_df = existing_future.result()
+
+    numeric_cols, percent_cols = _classify_cols(tuple(new_df.columns))
+
+    # do numeric and percent conversions; each column is converted at most once, so the dtypes
+    # looked up once up front stay valid for the columns that haven't been touched yet
+    frames = [(new_df, new_df.dtypes.to_dict()), (existing_df, existing_df.dtypes.to_dict())]
     for col in numeric_cols:
-        for df in [new_df, existing_df]:
+        for df, dtypes in frames:
             # if the column isn't already a float, replace strings and make numeric
-            if col not in dict(df.dtypes):
+            dtype = dtypes.get(col)
+            if dtype is None:
                 continue
-            if dict(df.dtypes)[col] == object:
-                df[col] = df[col].str.replace(',', '')
-                # also replace "X" characters with the number 1: they're generally placeholders
-                df[col] = df[col].str.replace('X', '1')
-                df[col] = pd.to_numeric(df[col])  # convert to numeric
-
-    def p2f(x):
-        try:
-            if pd.isnull(x):
-                return np.nan
-            else:
-                return float(x.strip('%'))/100
-        except Exception:
-            return np.nan
+            if dtype == object:
+                df[col] = pd.to_numeric(df[col].str.translate(_NUMERIC_TRANS), errors='coerce')
 
     for col in percent_cols:
-        for df in [new_df, existing_df]:
-            if col not in dict(df.dtypes):
+        for df, dtypes in frames:
+            dtype = dtypes.get(col)
+            if dtype is None:
                 continue
-            if dict(df.dtypes)[col] == object:
-                df[col] = df[col].str.replace('X', '1')
-            df[col] = df[col].apply(p2f)
+            values = df[col]
+            if dtype == object:
+                values = values.str.translate(_PERCENT_TRANS)
+            # anything that still doesn't parse as a number is treated as missing
+            df[col] = pd.to_numeric(values, errors='coerce') / 100
 
 
     ###########################################################################################
@@ -102,11 +160,10 @@ def make_output_string(gc):
     states_added = new_states.difference(old_states)
     states_dropped = old_states.difference(new_states)
 
-    out += 'State,Issue,Metric,Details\n'
     for state in states_dropped:
-        out += '%s,State removed!\n' % state
+        emit(state, 'State removed!')
     for state in states_added:
-        out += '%s,State added\n' % state
+        emit(state, 'State added')
 
     # Check any columns that were either dropped or added
     old_columns = set(existing_df.columns)
@@ -116,96 +173,153 @@ def make_output_string(gc):
     for col in columns_added:
         if col.startswith('Unnamed'):
             continue
-        out += 'All,New column added,%s\n' % col
+        emit('All', 'New column added', col)
 
     columns_removed = old_columns.difference(new_columns)
     for col in columns_removed:
         if col.startswith('Unnamed'):
             continue
-        out += 'All,Column removed,%s\n' % col
+        emit('All', 'Column removed', col)
+
+    # Percent columns only get the lost/new metric checks, and are compared after numeric columns
+    check_cols = [col for col in numeric_cols + percent_cols
+                  if col in old_columns and col in new_columns]
+
+    # Past this point the checks only need plain containers: map each state to its (first) row
+    # in each snapshot, and pull just the checked columns out as arrays aligned on those rows
+    new_rows = {}
+    for i, state in enumerate(new_df.Abbr):
+        new_rows.setdefault(state, i)
+    old_rows = {}
+    for i, state in enumerate(existing_df.Abbr):
+        old_rows.setdefault(state, i)
+    # only states present in both snapshots get value checks; dropped/added ones are flagged above
+    states = sorted(old_states & new_states)
+
+    old_mat = existing_df[check_cols].to_numpy(dtype=float)[[old_rows[s] for s in states]]
+    new_mat = new_df[check_cols].to_numpy(dtype=float)[[new_rows[s] for s in states]]
+    numeric_col_set = set(numeric_cols)
+    is_numeric = np.array([col in numeric_col_set for col in check_cols], dtype=bool)
+
+    # whitelist certain columns from triggering cumulative decrease alerts
+    whitelist_cols = ['Total Individuals not fully vaccinated']
+    not_whitelisted = np.array([col not in whitelist_cols for col in check_cols], dtype=bool)
+
+    lost, gained, decreased, doubled = _scan_checks(new_mat, old_mat, is_numeric, not_whitelisted)
+
+    # Check specific data for each state, formatting only the cells that tripped a check. Pull
+    # everything those cells need out in one gather per array, so the loop below works on plain
+    # Python values instead of indexing numpy scalars cell by cell.
+    hit_rows, hit_cols = np.nonzero(lost | gained | decreased | doubled)
+    hits = zip(
+        hit_rows.tolist(), hit_cols.tolist(),
+        old_mat[hit_rows, hit_cols].tolist(), new_mat[hit_rows, hit_cols].tolist(),
+        lost[hit_rows, hit_cols].tolist(), gained[hit_rows, hit_cols].tolist(),
+        decreased[hit_rows, hit_cols].tolist(), doubled[hit_rows, hit_cols].tolist())
+    for i, j, old_value, new_value, is_lost, is_gained, is_decreased, is_doubled in hits:
+        state = states[i]
+        col = check_cols[j]
+        # numeric values are truncated with %d, as the report has always printed them
+        value_fmt = '%d' if col in numeric_col_set else '%.2f'
+
+        if is_lost:
+            emit(state, 'Lost metric', col, 'Old value ' + value_fmt % old_value)
+        if is_gained:
+            emit(state, 'New metric', col, 'New value ' + value_fmt % new_value)
+        if is_decreased:
+            emit(state, 'Cumulative decrease', col, '%d -> %d' % (old_value, new_value))
+        if is_doubled:
+            emit(state, '>2x increase', col, '%d -> %d' % (old_value, new_value))
+
+    return rows
+
+
+_GSPREAD_SCOPES = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"]
+
+# The service account key file is read once per process. Each thread that runs the checks keeps
+# its own gspread client, created once and kept authorized by gspread's own token refresh: a
+# client's requests.Session isn't safe to share across threads, and within one run only a single
+# thread uses the client at a time (the parallel GitHub fetch never touches it).
+_credential_lock = threading.Lock()
+_credential = None
+_gc_local = threading.local()
+
+
+def _get_gspread_client():
+    global _credential
+    gc = getattr(_gc_local, 'gc', None)
+    if gc is None:
+        with _credential_lock:
+            if _credential is None:
+                _credential = ServiceAccountCredentials.from_json_keyfile_name(
+                    flask.current_app.config['CREDENTIALS_PATH'], _GSPREAD_SCOPES)
+        gc = _gc_local.gc = gspread.authorize(_credential)
+    return gc
+
+
+# The checks run in the background so /bi-checks doesn't tie up a request worker for the whole
+# pull. Tasks are tracked in memory by id, so they can only be polled on the process that
+# started them. Finished tasks stay pollable until more than _MAX_TASKS tasks are tracked, at
+# which point the oldest finished ones are dropped.
+_MAX_TASKS = 20
+_task_executor = ThreadPoolExecutor(max_workers=2)
+_tasks_lock = threading.Lock()
+_tasks = OrderedDict()
+
+
+def _run_bi_data_check(app):
+    with app.app_context():
+        try:
+            gc = _get_gspread_client()
 
-    # Check specific data for each state
-    for state in existing_df.Abbr:
-        # if this state has been dropped, continue and don't keep checking values
-        if state in states_dropped:
-            continue
+            rows = make_check_rows(gc)
 
-        new_row = new_df.loc[new_df.Abbr == state]
-        old_row = existing_df.loc[existing_df.Abbr == state]
-        state = old_row.Abbr.iloc[0]
-        
-        for col in numeric_cols:
-            if not (col in old_row and col in new_row):
-                continue
-            old_value = old_row[col].iloc[0]
-            new_value = new_row[col].iloc[0]
-
-            # Check things that were previously reported that are not now
-            if pd.isnull(new_value) and not pd.isnull(old_value):
-                out += '%s,Lost metric,%s,Old value %d\n' % (
-                    state, col, old_value)
-                
-            # Check things that were previously not reported and are reported now
-            if not pd.isnull(new_value) and pd.isnull(old_value):
-                out += '%s,New metric,%s,New value %d\n' % (
-                    state, col, new_value)
-                
-            if pd.isnull(new_value) or pd.isnull(old_value):
-                continue
-                
-            # Check any cumulative numbers that went down
-            if new_value < old_value:
-                # whitelist certain columns from triggering alerts
-                whitelist_cols = ['Total Individuals not fully vaccinated']
-                if col not in whitelist_cols:
-                    out += '%s,Cumulative decrease,%s,%d -> %d\n' % (
-                        state, col, old_value, new_value)
-                    
-            # Increase magnitude check, alert if >2x
-            if new_value > 2 * old_value:
-                out += '%s,>2x increase,%s,%d -> %d\n' % (
-                    new_row.Abbr.iloc[0], col, old_value, new_value)
-                
-        # Do new metric/lost metric checks for percentage columns, but don't compare numbers
-        for col in percent_cols:
-            if not (col in old_row and col in new_row):
-                continue
-            old_value = old_row[col].iloc[0]
-            new_value = new_row[col].iloc[0]
-            
-            if pd.isnull(new_value) and not pd.isnull(old_value):
-                out += '%s,Lost metric,%s,Old value %.2f\n' % (
-                    state, col, old_value)
-                
-            if not pd.isnull(new_value) and pd.isnull(old_value):
-                out += '%s,New metric,%s,New value %.2f\n' % (
-                    state, col, new_value)
+            sh = gc.open_by_key(app.config['CHECKS_SHEET_ID'])
+            title = datetime.today().strftime('%Y-%m-%d-temp')
+            worksheet = sh.add_worksheet(title=title, rows=str(len(rows)), cols="10")
+            worksheet.update([_CHECKS_HEADER] + rows)
+            worksheet.format('A1:D1', {'textFormat': {'bold': True}})
+        except Exception:
+            app.logger.exception('BI checks task failed')
+            raise
 
-    return out
+        return 'Done: sheet tab %s created' % title
 
 
 @api.route('/bi-checks', methods=['GET'])
 def bi_data_check():
-    credential = ServiceAccountCredentials.from_json_keyfile_name(
-        flask.current_app.config['CREDENTIALS_PATH'],
-        [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive.file",
-            "https://www.googleapis.com/auth/drive"])
-    gc = gspread.authorize(credential)
-
-    out = make_output_string(gc)
-    # return out
-    out_df = pd.read_csv(StringIO(out)).fillna('')
-
-    sh = gc.open_by_key(flask.current_app.config['CHECKS_SHEET_ID'])
-    title = datetime.today().strftime('%Y-%m-%d-temp')
-    worksheet = sh.add_worksheet(title=title, rows=str(out_df.shape[0]), cols="10")
-    worksheet.update([out_df.columns.values.tolist()] + out_df.values.tolist())
-    worksheet.format('A1:D1', {'textFormat': {'bold': True}})
-
-    return flask.jsonify('Done: sheet tab %s created' % title)
+    task_id = uuid.uuid4().hex
+    future = _task_executor.submit(_run_bi_data_check, flask.current_app._get_current_object())
+    with _tasks_lock:
+        _tasks[task_id] = future
+        excess = len(_tasks) - _MAX_TASKS
+        finished = [tid for tid, task in _tasks.items() if task.done()]
+        for tid in finished[:max(0, excess)]:
+            del _tasks[tid]
+    return flask.jsonify({'task_id': task_id, 'status': 'queued'}), 202
+
+
+@api.route('/bi-checks/<task_id>', methods=['GET'])
+def bi_data_check_status(task_id):
+    with _tasks_lock:
+        future = _tasks.get(task_id)
+    if future is None:
+        return flask.jsonify({'task_id': task_id, 'status': 'not found'}), 404
+
+    if not future.done():
+        status = 'running' if future.running() else 'queued'
+        return flask.jsonify({'task_id': task_id, 'status': status})
+
+    # the full error has already been logged by the task; don't leak its details to the client
+    if future.exception() is not None:
+        return flask.jsonify({'task_id': task_id, 'status': 'failed',
+                              'error': 'BI checks failed, see the server logs for details'})
+
+    return flask.jsonify({'task_id': task_id, 'status': 'done', 'result': future.result()})
 
 
 @api.route('/test', methods=['GET'])